@@ -1,31 +1,144 @@
-import copy
 import itertools
 
 import time
+from collections import deque
 
 
 class CSP:
     def __init__(self):
-        # self.variables is a list of the variable names in the CSP
+        # self.variables is a list of the variable names in the CSP.
+        # Internally the solver identifies a variable by its index in
+        # this list (its id); self.var_id maps a name back to its id.
+        # Names are only used when building the CSP and when returning
+        # the solution - everything on the solving paths is indexed by
+        # these small ints, so no string is ever hashed in a hot loop.
         self.variables = []
+        self.var_id = {}
 
         # self.domains[i] is a list of legal values for variable i
         self.domains = {}
 
-        # self.constraints[i][j] is a list of legal value pairs for
-        # the variable pair (i, j)
+        # self.constraints[i][j] is a tuple indexed by the bit index of
+        # a value x in the domain of i, holding a bitmask of all values
+        # y in the domain of j such that (x, y) satisfies the constraint
+        # between i and j. This lets the solver test "does any y support
+        # x" with a single AND instead of scanning a list of value pairs.
         self.constraints = {}
 
+        # Bitmask representation of the domains, used by the solver
+        # itself. Each value of a variable is assigned a bit index, so
+        # the whole domain fits in a single int (9 bits for Sudoku).
+        # self.val2bit[i][value] is the bit index of 'value' in the
+        # domain of variable i, self.bit2val[i] is the inverse mapping,
+        # and self.bit_domains[i] is the full domain as a bitmask.
+        self.val2bit = {}
+        self.bit2val = {}
+        self.bit_domains = {}
+
+        # Precomputed adjacency: self.arcs is the list of all (i, j)
+        # arcs in creation order, and self.neighbor_arcs[j] is the list
+        # of arcs (i, j) pointing at variable j. Both are maintained by
+        # add_constraint_one_way, so get_all_arcs and
+        # get_all_neighboring_arcs never have to rebuild them.
+        self.arcs = []
+        self.neighbor_arcs = {}
+
+        # self.peers[i] is the list of variables j that i has an
+        # outgoing arc (i, j) to. The heuristics iterate this flat list
+        # instead of walking the keys of the constraints dict.
+        # self._id_peers is the same adjacency with both the index and
+        # the entries as variable ids, built by _build_ac4_tables.
+        self.peers = {}
+        self._id_peers = []
+
         # Variables needed for assignment
         self.backtrack_called = self.backtrack_failed = 0
 
+        # Trail of ('domain', variable, old bitmask),
+        # ('counter', key, old count) and ('unassigned', variable, None)
+        # tuples, recording every domain pruning, every AC-4 counter
+        # decrement and every variable decided during search.
+        # Instead of deep copying the whole assignment for every value
+        # tried, backtrack remembers the length of the trail before
+        # trying a value, and pops/restores entries back to that mark
+        # when the value fails.
+        self.trail = []
+
+        # The set of variables whose domain still has more than one bit
+        # set. It is initialized by backtracking_search and kept in sync
+        # by backtrack and inference (via 'unassigned' trail entries),
+        # so select_unassigned_variable only ever scans the variables
+        # that are actually undecided.
+        self.unassigned = set()
+
+        # True as long as every constraint in the CSP is a plain
+        # 'not equal' constraint (which is all Sudoku needs). In that
+        # case backtracking_search uses the packed fast path below;
+        # adding any constraint through the generic
+        # add_constraint_one_way clears the flag.
+        self._only_not_equal = True
+
+        # The set of arcs (i, j) whose constraint is exactly 'not
+        # equal'. In a CSP that mixes constraint kinds, these arcs are
+        # excluded from the AC-4 counter machinery: 'x != y' can only
+        # prune i once j is down to a single value, so inference handles
+        # them with a direct bit-clear instead. self._neq_watch[j] is
+        # built by _build_ac4_tables and lists, for each not-equal arc
+        # (i, j), the peer id i together with a translation table from
+        # the bit indices of j to the corresponding single-bit masks of
+        # i (0 where i does not have the value at all).
+        self._not_equal_pairs = set()
+        self._neq_watch = []
+
+        # The variable groups handed to add_all_different_constraint
+        # (the 27 row/column/box units for Sudoku). The packed
+        # propagator scans these for hidden singles - a value that only
+        # one cell of a unit can take - which the pairwise 'not equal'
+        # decomposition of Alldiff can never deduce on its own.
+        self.all_different_groups = []
+
+        # Packed representation of the whole CSP state as one big int,
+        # built lazily by _init_packed. Every variable gets a fixed-width
+        # field of bits, one bit per value in the shared value universe,
+        # so the complete assignment is a single Python int. Undo in the
+        # packed search is then just keeping the previous int around -
+        # no trail and no copying is needed, since ints are immutable.
+        self._packed_offsets = None
+        self._packed_field = 0
+        self._packed_values = []
+        self._packed_peers = []
+
+        # The propagation kernel used by the packed search.
+        # _init_packed replaces it with a generated function that has
+        # this CSP's topology compiled in; _propagate_packed is the
+        # readable reference implementation it is generated from.
+        self._propagate = self._propagate_packed
+
+        # AC-4 bookkeeping, built by _build_ac4_tables at the start of
+        # backtracking_search. self.ac4_counter[(i, j, x)] is the number
+        # of values y in the domain of j that support value (bit index)
+        # x in the domain of i. self.ac4_support_list[(j, y)] is a list
+        # of (i, x) pairs that lose a support when value y is removed
+        # from the domain of j.
+        self.ac4_counter = {}
+        self.ac4_support_list = {}
+
     def add_variable(self, name, domain):
         """Add a new variable to the CSP. 'name' is the variable name
         and 'domain' is a list of the legal values for the variable.
         """
+        self.var_id[name] = len(self.variables)
         self.variables.append(name)
         self.domains[name] = list(domain)
         self.constraints[name] = {}
+        self.neighbor_arcs[name] = []
+        self.peers[name] = []
+
+        # Assign every value a bit index, so the domain can be
+        # represented as a bitmask with all bits set
+        self.val2bit[name] = {value: bit for bit, value in enumerate(self.domains[name])}
+        self.bit2val[name] = list(self.domains[name])
+        self.bit_domains[name] = (1 << len(self.domains[name])) - 1
 
     def get_all_possible_pairs(self, a, b):
         """Get a list of all possible pairs (as tuples) of the values in
@@ -37,15 +150,19 @@ class CSP:
     def get_all_arcs(self):
         """Get a list of all arcs/constraints that have been defined in
         the CSP. The arcs/constraints are represented as tuples (i, j),
-        indicating a constraint between variable 'i' and 'j'.
+        indicating a constraint between variable 'i' and 'j'. The list
+        is maintained by add_constraint_one_way and must not be mutated
+        by the caller.
         """
-        return [(i, j) for i in self.constraints for j in self.constraints[i]]
+        return self.arcs
 
     def get_all_neighboring_arcs(self, var):
         """Get a list of all arcs/constraints going to/from variable
         'var'. The arcs/constraints are represented as in get_all_arcs().
+        The list is maintained by add_constraint_one_way and must not be
+        mutated by the caller.
         """
-        return [(i, var) for i in self.constraints[var]]
+        return self.neighbor_arcs[var]
 
     def add_constraint_one_way(self, i, j, filter_function):
         """Add a new constraint between variables 'i' and 'j'. The legal
@@ -56,62 +173,520 @@ class CSP:
         to add the constraint the other way, j -> i, as all constraints
         are supposed to be two-way connections!
         """
+        # An arbitrary filter function cannot be handled by the packed
+        # not-equal fast path, and an arc refined by one is no longer a
+        # plain 'not equal' arc
+        self._only_not_equal = False
+        self._not_equal_pairs.discard((i, j))
+
         if not j in self.constraints[i]:
-            # First, get a list of all possible pairs of values between variables i and j
-            self.constraints[i][j] = self.get_all_possible_pairs(self.domains[i], self.domains[j])
+            # Start from a table where every pair of values is allowed,
+            # and register the new arc in the adjacency structures
+            self.constraints[i][j] = ((1 << len(self.domains[j])) - 1,) * len(self.domains[i])
+            self.arcs.append((i, j))
+            self.neighbor_arcs[j].append((i, j))
+            self.peers[i].append(j)
 
-        # Next, filter this list of value pairs through the function
-        # 'filter_function', so that only the legal value pairs remain
-        self.constraints[i][j] = list(filter(lambda value_pair: filter_function(*value_pair), self.constraints[i][j]))
+        # Next, filter the support table through the function
+        # 'filter_function', so that only the legal value pairs remain.
+        # The table is built directly as a tuple of bitmasks - no list
+        # of value pairs is ever materialized.
+        support = []
+        for x_bit, allowed in enumerate(self.constraints[i][j]):
+            x = self.bit2val[i][x_bit]
+            mask = 0
+            while allowed:
+                y_bit = allowed & -allowed
+                allowed ^= y_bit
+                if filter_function(x, self.bit2val[j][y_bit.bit_length() - 1]):
+                    mask |= y_bit
+            support.append(mask)
+        self.constraints[i][j] = tuple(support)
+
+    def add_not_equal_constraint_one_way(self, i, j):
+        """Add a 'not equal' constraint between variables 'i' and 'j',
+        one way, from i -> j. Equivalent to calling
+        add_constraint_one_way(i, j, lambda x, y: x != y), but the
+        support table is written in closed form - the mask for a value x
+        is simply the domain of j with the bit of x (if j has that
+        value) cleared - so no filter function is evaluated per value
+        pair.
+        """
+        if not j in self.constraints[i]:
+            # Start from a table where every pair of values is allowed,
+            # and register the new arc in the adjacency structures
+            self.constraints[i][j] = ((1 << len(self.domains[j])) - 1,) * len(self.domains[i])
+            self.arcs.append((i, j))
+            self.neighbor_arcs[j].append((i, j))
+            self.peers[i].append(j)
+            # A fresh arc built here is exactly 'not equal'
+            self._not_equal_pairs.add((i, j))
+
+        val2bit_j = self.val2bit[j]
+        support = []
+        for x_bit, allowed in enumerate(self.constraints[i][j]):
+            y_bit = val2bit_j.get(self.bit2val[i][x_bit])
+            if y_bit is not None:
+                allowed &= ~(1 << y_bit)
+            support.append(allowed)
+        self.constraints[i][j] = tuple(support)
+
+        # Fuse the initial consistency pass over the given cells into
+        # construction: if i is already decided, its value can never be
+        # used by j, so it is removed from j's start domain right away.
+        # This way the search starts from domains that are already
+        # reduced by the givens, instead of discovering the same
+        # removals one by one when the AC-4 tables are built.
+        domain_i = self.bit_domains[i]
+        if domain_i and domain_i & (domain_i - 1) == 0:
+            y_bit = val2bit_j.get(self.bit2val[i][domain_i.bit_length() - 1])
+            if y_bit is not None:
+                self.bit_domains[j] &= ~(1 << y_bit)
 
     def add_all_different_constraint(self, variables):
         """Add an Alldiff constraint between all of the variables in the
         list 'variables'.
         """
+        # Remember the group itself: the packed propagator uses it for
+        # hidden-single detection, which the pairwise decomposition
+        # below cannot express
+        self.all_different_groups.append(list(variables))
+
         for (i, j) in self.get_all_possible_pairs(variables, variables):
             if i != j:
-                self.add_constraint_one_way(i, j, lambda x, y: x != y)
+                self.add_not_equal_constraint_one_way(i, j)
 
     def backtracking_search(self):
         """This functions starts the CSP solver and returns the found
         solution.
         """
-        # Make a so-called "deep copy" of the dictionary containing the
-        # domains of the CSP variables. The deep copy is required to
-        # ensure that any changes made to 'assignment' does not have any
-        # side effects elsewhere.
-        assignment = copy.deepcopy(self.domains)
+        # If every constraint is a plain 'not equal' (as in Sudoku), use
+        # the packed fast path that keeps the whole state in one int
+        if self._only_not_equal and self.variables:
+            return self._backtracking_search_packed()
+
+        # Build the working assignment as a flat list of domain
+        # bitmasks indexed by variable id. The list is a fresh copy, so
+        # changes made to 'assignment' have no side effects elsewhere,
+        # and the solver never touches a variable name from here on.
+        # A plain list (rather than e.g. array.array) is deliberate:
+        # this is the only copy made per search - the trail undoes all
+        # later changes in place - and a list imposes no limit on the
+        # domain size, where a fixed-width array would cap domains at
+        # the machine word.
+        assignment = [self.bit_domains[var] for var in self.variables]
+
+        # The construction-time pruning over the given cells may already
+        # have emptied a domain, in which case the CSP has no solution
+        if not all(assignment):
+            return False
+
+        # Build the AC-4 support counters and support lists, then run
+        # AC-4 on the values that turned out to have no support at all,
+        # to weed out all of the values that are not arc-consistent to
+        # begin with
+        removals = self._build_ac4_tables(assignment)
+
+        # Building the tables prunes values itself (unsupported values
+        # and not-equal arcs with a decided neighbor), and may already
+        # have emptied a domain. inference only notices wipeouts it
+        # causes, so check again here before relying on it
+        if not all(assignment):
+            return False
+
+        if not self.inference(assignment, removals):
+            return False
+
+        # Collect the variables that are still undecided after the
+        # initial propagation - backtrack and inference keep this set in
+        # sync from here on
+        self.unassigned = {var for var, domain in enumerate(assignment)
+                           if domain & (domain - 1)}
 
-        # Run AC-3 on all constraints in the CSP, to weed out all of the
-        # values that are not arc-consistent to begin with
-        self.inference(assignment, self.get_all_arcs())
+        # Call backtrack with the partial assignment 'assignment', and
+        # convert the bitmask solution back to names and lists of values
+        result = self.backtrack(assignment)
+        if not result:
+            return result
+        return {name: [self.bit2val[name][result[var].bit_length() - 1]]
+                for var, name in enumerate(self.variables)}
 
-        # Call backtrack with the partial assignment 'assignment'
-        return self.backtrack(assignment)
+    def _init_packed(self):
+        """Build the packed single-int representation of the CSP.
+
+        All domains are re-encoded onto a shared value universe, so that
+        the same bit means the same value in every variable - required
+        for 'not equal' to be expressible as clearing one bit. Variable
+        number k then occupies the bits
+        [k * width, (k + 1) * width) of the state int, where 'width' is
+        the size of the universe (9 bits per cell for Sudoku, 729 bits
+        for the whole board).
+        """
+        if self._packed_offsets is not None:
+            return
+
+        # The shared universe of values, in first-seen order
+        value_bit = {}
+        values = []
+        for var in self.variables:
+            for value in self.domains[var]:
+                if value not in value_bit:
+                    value_bit[value] = len(values)
+                    values.append(value)
+
+        width = len(values)
+        index = {var: k for k, var in enumerate(self.variables)}
+
+        self._packed_values = values
+        self._packed_value_bit = value_bit
+        self._packed_width = width
+        self._packed_field = (1 << width) - 1
+        self._packed_offsets = [k * width for k in range(len(self.variables))]
+        self._packed_peers = [tuple(index[j] for j in self.peers[var])
+                              for var in self.variables]
+
+        # self._packed_spread[k] has bit 0 of every peer field of
+        # variable k set. Multiplying a single value bit b by spread[k]
+        # replicates b into the field of every peer at once, so the
+        # whole peer set can be tested and cleared with one multiply
+        # and one AND instead of a loop over the peers.
+        self._packed_spread = [sum(1 << offset for offset in
+                                   (self._packed_offsets[p] for p in peer_tuple))
+                               for peer_tuple in self._packed_peers]
+
+        # Hidden-single reasoning ("a value possible in only one cell
+        # of the unit must go in that cell") assumes the unit has to
+        # use every one of its candidate values. That only holds for
+        # 'tight' units with exactly as many candidate values as cells
+        # (every Sudoku unit: 9 cells, 9 values); a smaller group is
+        # free to leave values unused, and deciding cells on such a
+        # group would prune real solutions. Only the tight units take
+        # part in the hidden-single scan. Tightness is checked against
+        # the domains as they stand now - domains only ever shrink, so
+        # a unit that is tight here stays tight for the whole search.
+        self._packed_tight_units = []
+        for group in self.all_different_groups:
+            union = 0
+            for var in group:
+                domain = self.bit_domains[var]
+                bit2val = self.bit2val[var]
+                while domain:
+                    bit = domain & -domain
+                    domain ^= bit
+                    union |= 1 << value_bit[bit2val[bit.bit_length() - 1]]
+            if union.bit_count() == len(group):
+                self._packed_tight_units.append(
+                    tuple(index[var] for var in group))
+
+        # self._packed_hole[k] is the state mask with variable k's field
+        # zeroed out and every other bit set, so overwriting a field is
+        # one AND plus one OR without shifting the field mask each time
+        self._packed_hole = [~(self._packed_field << offset)
+                             for offset in self._packed_offsets]
+
+        # Since the topology is now fixed, generate a propagation
+        # kernel specialized to it
+        self._propagate = self._codegen_propagate()
+
+    def _codegen_propagate(self):
+        """Generate and compile a propagation function specialized to
+        this CSP's topology, mirroring _propagate_packed (see there for
+        how the algorithm works).
+
+        The topology never changes once the search starts, so instead
+        of indexing offset/spread/unit tables at runtime, the generated
+        source bakes them in: the shift amounts and masks of the
+        naked-single pass are literal constants, and the hidden-single
+        scan is fully unrolled into straight-line code per tight unit
+        (see _init_packed for why only tight units are sound) - no loop
+        over the units, no loop over the cells of a unit, and no table
+        lookups are left. One extra deduction falls out of the unrolled
+        form for free: two hidden singles landing in the same cell are
+        detected as an immediate dead end, which is again only valid
+        because a tight unit must place both values somewhere.
+        """
+        offsets = self._packed_offsets
+        field_mask = self._packed_field
+
+        lines = [
+            "def propagate(state, worklist, _offsets=%r, _spread=%r, _hole=%r):" % (
+                tuple(offsets), tuple(self._packed_spread), tuple(self._packed_hole)),
+            "    push = worklist.append",
+            "    pop = worklist.pop",
+            "    while True:",
+            "        while worklist:",
+            "            k = pop()",
+            "            bit = (state >> _offsets[k]) & %d" % field_mask,
+            "            hit = state & (bit * _spread[k])",
+            "            if not hit:",
+            "                continue",
+            "            state ^= hit",
+            "            while hit:",
+            "                occurrence = hit & -hit",
+            "                hit ^= occurrence",
+            "                peer = (occurrence.bit_length() - 1) // %d" % self._packed_width,
+            "                field = (state >> _offsets[peer]) & %d" % field_mask,
+            "                if field == 0:",
+            "                    return 0",
+            "                if field & (field - 1) == 0:",
+            "                    push(peer)",
+        ]
+
+        for unit in self._packed_tight_units:
+            lines.append("        once = more = 0")
+            for cell, k in enumerate(unit):
+                lines.append("        f%d = (state >> %d) & %d" % (cell, offsets[k], field_mask))
+                lines.append("        more |= once & f%d" % cell)
+                lines.append("        once |= f%d" % cell)
+            lines.append("        singles = once & ~more")
+            lines.append("        if singles:")
+            for cell, k in enumerate(unit):
+                lines.append("            b = f%d & singles" % cell)
+                lines.append("            if b:")
+                lines.append("                if b & (b - 1):")
+                lines.append("                    return 0")
+                lines.append("                if f%d != b:" % cell)
+                lines.append("                    state = (state & _hole[%d]) | (b << %d)" % (k, offsets[k]))
+                lines.append("                    push(%d)" % k)
+
+        lines.append("        if not worklist:")
+        lines.append("            return state")
+
+        namespace = {}
+        exec(compile("\n".join(lines), "<generated propagate>", "exec"), namespace)
+        return namespace["propagate"]
+
+    def _backtracking_search_packed(self):
+        """The packed counterpart of backtracking_search, used when
+        every constraint is 'not equal'. The whole assignment lives in
+        one int, so trying a value is building a new int and undoing is
+        simply keeping the old one - ints are immutable, and no deep
+        copy or trail is involved.
+        """
+        self._init_packed()
+        offsets = self._packed_offsets
+        field_mask = self._packed_field
+        value_bit = self._packed_value_bit
+
+        # Pack the current domains into the state int, translating each
+        # variable's own bit indices to the shared universe bits
+        state = 0
+        for k, var in enumerate(self.variables):
+            domain = self.bit_domains[var]
+            bit2val = self.bit2val[var]
+            field = 0
+            while domain:
+                bit = domain & -domain
+                domain ^= bit
+                field |= 1 << value_bit[bit2val[bit.bit_length() - 1]]
+            if field == 0:
+                # Construction-time pruning emptied this domain
+                return False
+            state |= field << offsets[k]
+
+        # Propagate all variables that are already decided (the givens)
+        worklist = []
+        for k in range(len(self.variables)):
+            field = (state >> offsets[k]) & field_mask
+            if field & (field - 1) == 0:
+                worklist.append(k)
+        state = self._propagate(state, worklist)
+        if not state:
+            return False
+
+        result = self._backtrack_packed(state)
+        if not result:
+            return False
+
+        # Unpack the solution back to the dictionary-of-lists format
+        values = self._packed_values
+        return {var: [values[((result >> offsets[k]) & field_mask).bit_length() - 1]]
+                for k, var in enumerate(self.variables)}
+
+    def _backtrack_packed(self, state):
+        """The packed counterpart of 'backtrack'. 'state' is the whole
+        assignment as one int. Returns the solved state, or 0 if it has
+        no solution.
+
+        The search is iterative: instead of recursing, an explicit stack
+        holds one (state, variable, candidate iterator) frame per
+        decision. Exhausting a frame's candidates pops it (a backtrack),
+        and since every frame keeps its own state int, undoing is again
+        just dropping the failed trial state on the floor.
+        """
+        offsets = self._packed_offsets
+        field_mask = self._packed_field
+        peers = self._packed_peers
+        hole = self._packed_hole
+        stack = []
+
+        while True:
+            # Expand a node for 'state'
+            self.backtrack_called += 1
+
+            # Minimum-remaining-values: find the undecided variable with
+            # the smallest domain, breaking ties on degree and then on
+            # variable number (so the search is reproducible)
+            best = -1
+            best_key = None
+            for k in range(len(offsets)):
+                field = (state >> offsets[k]) & field_mask
+                if field & (field - 1):
+                    key = (field.bit_count(), -len(peers[k]))
+                    if best_key is None or key < best_key:
+                        best_key = key
+                        best = k
+            if best < 0:
+                # Every field has a single bit set - 'state' is a solution
+                return state
+
+            # Least-constraining-value: try the value that leaves the
+            # most options open for the peers first
+            field = (state >> offsets[best]) & field_mask
+            candidates = []
+            while field:
+                bit = field & -field
+                field ^= bit
+                score = sum(((state >> offsets[peer]) & field_mask & ~bit).bit_count()
+                            for peer in peers[best])
+                candidates.append((score, bit))
+            candidates.sort(key=lambda item: -item[0])
+
+            stack.append((state, best, iter(candidates)))
+
+            # Advance the deepest frame that still has candidates left
+            while stack:
+                frame_state, var, candidate_iter = stack[-1]
+                candidate = next(candidate_iter, None)
+                if candidate is None:
+                    # All values for this variable failed - backtrack
+                    stack.pop()
+                    self.backtrack_failed += 1
+                    continue
+
+                # Build the trial state with the candidate as the only
+                # value of the chosen variable; the frame's own state
+                # stays untouched as the undo point
+                trial = (frame_state & hole[var]) | (candidate[1] << offsets[var])
+                trial = self._propagate(trial, [var])
+                if trial:
+                    state = trial
+                    break
+            else:
+                # The stack is empty - the whole search space is exhausted
+                return 0
+
+    def _propagate_packed(self, state, worklist):
+        """Constraint propagation on the packed state, alternating two
+        passes until neither finds anything new.
+
+        Naked singles: every variable on the worklist has a single value
+        left, which is removed from the fields of all its peers; any
+        peer reduced to a single value is pushed on the worklist in
+        turn. For 'not equal' constraints this reaches exactly the
+        arc-consistent fixpoint that AC-4 reaches on the unpacked
+        domains.
+
+        Hidden singles: within each tight all-different unit (one that
+        has exactly as many candidate values as cells, and so must use
+        all of them - see _init_packed), a value that only appears in
+        one cell's field must go in that cell, even if the cell still
+        has other candidates. This is a consequence of the whole
+        Alldiff that the pairwise decomposition can never deduce, and
+        it decides cells well before the search would have to branch on
+        them. Each detected hidden single goes back on the worklist for
+        another naked-single pass.
+
+        Returns the propagated state, or 0 if some domain was emptied.
+        """
+        offsets = self._packed_offsets
+        field_mask = self._packed_field
+        spread = self._packed_spread
+        width = self._packed_width
+        units = self._packed_tight_units
+        hole = self._packed_hole
+        push = worklist.append
+
+        while True:
+            # Pass 1: cascade the naked singles on the worklist
+            while worklist:
+                k = worklist.pop()
+                bit = (state >> offsets[k]) & field_mask
+
+                # Replicate the decided bit into the field of every peer
+                # at once: 'hit' holds the occurrences that are actually
+                # present, i.e. exactly the peer fields that will change
+                hit = state & (bit * spread[k])
+                if not hit:
+                    continue
+                state ^= hit
+
+                # Only the changed peers need to be inspected for
+                # wipe-out or for having become a naked single
+                while hit:
+                    occurrence = hit & -hit
+                    hit ^= occurrence
+                    peer = (occurrence.bit_length() - 1) // width
+                    field = (state >> offsets[peer]) & field_mask
+                    if field == 0:
+                        # The peer has no values left - dead end
+                        return 0
+                    if field & (field - 1) == 0:
+                        # The peer is down to a single value - propagate
+                        push(peer)
+
+            # Pass 2: look for hidden singles in the tight units
+            for unit in units:
+                # 'once' collects the values seen in the unit so far,
+                # 'more' the values seen in at least two fields
+                once = 0
+                more = 0
+                for k in unit:
+                    field = (state >> offsets[k]) & field_mask
+                    more |= once & field
+                    once |= field
+
+                singles = once & ~more
+                while singles:
+                    bit = singles & -singles
+                    singles ^= bit
+                    # Find the one cell whose field holds 'bit', and
+                    # decide it if it is not already a naked single
+                    for k in unit:
+                        field = (state >> offsets[k]) & field_mask
+                        if field & bit:
+                            if field != bit:
+                                state = (state & hole[k]) | (bit << offsets[k])
+                                push(k)
+                            break
+
+            if not worklist:
+                # Neither pass found anything new - fixpoint reached
+                return state
 
     def backtrack(self, assignment):
         """The function 'Backtrack' from the pseudocode in the
         textbook.
 
         The function is called recursively, with a partial assignment of
-        values 'assignment'. 'assignment' is a dictionary that contains
-        a list of all legal values for the variables that have *not* yet
-        been decided, and a list of only a single value for the
-        variables that *have* been decided.
+        values 'assignment'. 'assignment' is a list, indexed by variable
+        id, of bitmasks of legal values: several bits are set for the
+        variables that have *not* yet been decided, and a single bit is
+        set for the variables that *have* been decided.
 
-        When all of the variables in 'assignment' have lists of length
-        one, i.e. when all variables have been assigned a value, the
+        When all of the variables in 'assignment' have exactly one bit
+        set, i.e. when all variables have been assigned a value, the
         function should return 'assignment'. Otherwise, the search
         should continue. When the function 'inference' is called to run
-        the AC-3 algorithm, the lists of legal values in 'assignment'
-        should get reduced as AC-3 discovers illegal values.
-
-        IMPORTANT: For every iteration of the for-loop in the
-        pseudocode, you need to make a deep copy of 'assignment' into a
-        new variable before changing it. Every iteration of the for-loop
-        should have a clean slate and not see any traces of the old
-        assignments and inferences that took place in previous
-        iterations of the loop.
+        the AC-4 algorithm, the domain bitmasks in 'assignment' should
+        get reduced as AC-4 discovers illegal values.
+
+        Every iteration of the for-loop should have a clean slate and
+        not see any traces of the old assignments and inferences that
+        took place in previous iterations of the loop. Rather than deep
+        copying 'assignment' for every value tried, every domain change
+        is recorded on self.trail, and the trail is unwound back to the
+        mark taken before the value was tried whenever the value fails.
         """
         self.backtrack_called += 1
 
@@ -121,24 +696,54 @@ class CSP:
         unassigned_variable = self.select_unassigned_variable(assignment)
 
         for value in self.order_domain_values(unassigned_variable, assignment):
-            assignment_copy = copy.deepcopy(assignment)
+            # Remember how long the trail is before trying this value,
+            # so every change made below can be undone if it fails
+            mark = len(self.trail)
 
             # As value is from the domain of unassigned_variable, the value
             # is by definition consistent with assignment.
             # We therefore skip "if value is consistent with assignment" from the book
 
-            # Set value to be the only legal option for unassigned_variable
-            assignment_copy[unassigned_variable] = [value]
-            
+            # Set value to be the only legal option for unassigned_variable,
+            # and collect the bit indices of the values this deletes, as
+            # those are what AC-4 propagates from
+            old_domain = assignment[unassigned_variable]
+            self.trail.append(('domain', unassigned_variable, old_domain))
+            assignment[unassigned_variable] = value
+
+            # The variable is now decided - take it out of the
+            # unassigned set until the trail restores it
+            self.unassigned.remove(unassigned_variable)
+            self.trail.append(('unassigned', unassigned_variable, None))
+
+            removals = []
+            removed_bits = old_domain & ~value
+            while removed_bits:
+                bit = removed_bits & -removed_bits
+                removed_bits ^= bit
+                removals.append((unassigned_variable, bit.bit_length() - 1))
+
             # if self.interference, then there has been no inconsistency found (meaning the value
-            # is legal for the current assignment_copy):
-            if self.inference(assignment_copy, self.get_all_neighboring_arcs(unassigned_variable)):
-                # Run this function recursively on assignment_copy:
-                result = self.backtrack(assignment_copy)
+            # is legal for the current assignment):
+            if self.inference(assignment, removals):
+                # Run this function recursively on assignment:
+                result = self.backtrack(assignment)
                 # If result, then there has been found a legal solution. Return it!
                 if result:
                     return result
 
+            # The value failed - pop the trail back to the mark,
+            # restoring every domain and support counter that was
+            # changed while trying it
+            while len(self.trail) > mark:
+                kind, key, old = self.trail.pop()
+                if kind == 'domain':
+                    assignment[key] = old
+                elif kind == 'counter':
+                    self.ac4_counter[key] = old
+                else:
+                    self.unassigned.add(key)
+
         # If we are here, then there are no legal values for unassigned_variable. This means that the
         # current iteration has no solution, at which point we return false
         self.backtrack_failed += 1
@@ -146,73 +751,229 @@ class CSP:
 
         
     def order_domain_values(self, var, assignment):
-        """Order domain values connected to var.
-        
-        Can be implemented with a least-constraining-value heuristic, but
-        it currently only returns assignment[var]"""
-        return assignment[var]
+        """Order domain values connected to var, as a list of
+        single-bit masks, using the least-constraining-value heuristic.
+
+        Each candidate value is scored by how many legal values it
+        leaves in the domains of the neighboring variables - a single
+        AND plus a popcount per neighbor. Trying the value that rules
+        out the fewest choices for the neighbors first tends to steer
+        the search away from dead ends (Russel & Norvig, 2016)."""
+        values = []
+        domain = assignment[var]
+        while domain:
+            bit = domain & -domain
+            domain ^= bit
+            # Count the values left for the neighbors if 'bit' is chosen
+            score = sum((assignment[neighbor] & ~bit).bit_count()
+                        for neighbor in self._id_peers[var])
+            values.append((score, bit))
+
+        values.sort(key=lambda item: -item[0])
+        return [bit for (score, bit) in values]
 
     def assignment_is_done(self, assignment):
-            """Checks if assignment is done"""
-            for possibilities in assignment.values():
-                if len(possibilities) > 1:
-                     return False
-            return True
+            """Checks if assignment is done, i.e. if no variable is left
+            in the unassigned set"""
+            return not self.unassigned
 
     def select_unassigned_variable(self, assignment):
         """The function 'Select-Unassigned-Variable' from the pseudocode
-        in the textbook. Should return the name of one of the variables
-        in 'assignment' that have not yet been decided, i.e. whose list
-        of legal values has a length greater than one.
+        in the textbook. Should return the id of one of the variables
+        in 'assignment' that have not yet been decided, i.e. whose
+        domain bitmask has more than one bit set.
         """
-        # Filter out all elements where the domain is 1 (where there is only one legal value)
-        undecided_variables = filter(lambda item: len(item[1]) > 1, assignment.items())
-
-        # Return the name of the  element with the smalles domain, using minimum-remaining-values heuristic.
-        # While this is not technically needed, it usually performs better than random ordering, sometimes
-        # by a factor of 1000 or more (Russel & Norvig, 2016)
-        return min(undecided_variables, key=lambda item: len(item[1]))[0]
+        # Return the id of the unassigned variable with the smallest domain,
+        # using the minimum-remaining-values heuristic. While this is not
+        # technically needed, it usually performs better than random ordering,
+        # sometimes by a factor of 1000 or more (Russel & Norvig, 2016).
+        # Ties are broken by preferring the variable involved in the most
+        # constraints (the degree heuristic), and finally by the variable
+        # id, so the choice does not depend on the iteration order of the
+        # set.
+        # Only the variables that are actually undecided are scanned,
+        # rather than the whole assignment.
+        return min(self.unassigned,
+                   key=lambda var: (assignment[var].bit_count(),
+                                    -len(self._id_peers[var]), var))
         
 
-    def inference(self, assignment, queue):
-        """The function 'AC-3' from the pseudocode in the textbook.
-        'assignment' is the current partial assignment, that contains
-        the lists of legal values for each undecided variable. 'queue'
-        is the initial queue of arcs that should be visited.
+    def _build_ac4_tables(self, assignment):
+        """Initialize the AC-4 support counters and support lists from
+        the current domains. For every arc (i, j) and every value x in
+        the domain of i, ac4_counter[(i, j, x)] is set to the number of
+        supporting values in the domain of j, and x is registered on the
+        support list of each of those supporting values.
+
+        Values that have no support at all are pruned right away, and
+        returned as a list of (variable id, bit index) removals that
+        should be passed to 'inference' to cascade the consequences.
+        Everything here is keyed by variable ids, not names.
         """
-        queue_set = set(queue)
-        while len(queue_set) > 0:
-            (xi, xj) = queue_set.pop() # pair is a tuple. Example: ('0-0', '0-1')
-
-            if self.revise(assignment, xi, xj):
-                # If this is true, then the domain of xi has been revised
-                if len(assignment[xi]) == 0:
-                    # if self.domains[xi] is empty, then the CSP has no solution
-                    return False
-                for neighbor_tuple in self.get_all_neighboring_arcs(xi):
-                    queue_set.add(neighbor_tuple)
-        return True
+        self.ac4_counter = {}
+        self.ac4_support_list = {}
+        removals = []
+        var_id = self.var_id
+
+        # Translate the peer lists to ids as well, for the heuristics
+        self._id_peers = [tuple(var_id[peer] for peer in self.peers[name])
+                          for name in self.variables]
+
+        self._neq_watch = [[] for _ in self.variables]
+
+        # The counters must all be computed against the same snapshot of
+        # the domains. Pruning happens on 'assignment' while the
+        # counters are built, so counting against 'assignment' directly
+        # would make the cascade in 'inference' decrement the removed
+        # values a second time.
+        initial_domains = list(assignment)
+
+        for (i_name, j_name) in self.get_all_arcs():
+            support = self.constraints[i_name][j_name]
+            i = var_id[i_name]
+            j = var_id[j_name]
+
+            if (i_name, j_name) in self._not_equal_pairs:
+                # A 'not equal' arc never needs support counting: x only
+                # loses its support once the domain of j is the single
+                # value x. Register a watch that translates each bit of
+                # j to the matching single-bit mask of i, and prune
+                # right away if j is already decided.
+                val2bit_i = self.val2bit[i_name]
+                bit2val_j = self.bit2val[j_name]
+                watch = []
+                for value in bit2val_j:
+                    x = val2bit_i.get(value)
+                    watch.append(0 if x is None else 1 << x)
+                self._neq_watch[j].append((i, tuple(watch)))
+
+                domain_j = initial_domains[j]
+                if domain_j & (domain_j - 1) == 0:
+                    mask = watch[domain_j.bit_length() - 1]
+                    if mask and assignment[i] & mask:
+                        self.trail.append(('domain', i, assignment[i]))
+                        assignment[i] &= ~mask
+                        removals.append((i, mask.bit_length() - 1))
+                continue
 
+            remaining = initial_domains[i]
+            while remaining:
+                bit = remaining & -remaining
+                remaining ^= bit
+                x = bit.bit_length() - 1
 
-    def revise(self, assignment, i, j):
-        """The function 'Revise' from the pseudocode in the textbook.
-        'assignment' is the current partial assignment, that contains
-        the lists of legal values for each undecided variable. 'i' and
-        'j' specifies the arc that should be visited. If a value is
-        found in variable i's domain that doesn't satisfy the constraint
-        between i and j, the value should be deleted from i's list of
-        legal values in 'assignment'.
+                supporters = support[x] & initial_domains[j]
+                self.ac4_counter[(i, j, x)] = supporters.bit_count()
+
+                # Register (i, x) on the support list of every value y
+                # in the domain of j that supports it
+                while supporters:
+                    y_bit = supporters & -supporters
+                    supporters ^= y_bit
+                    self.ac4_support_list.setdefault(
+                        (j, y_bit.bit_length() - 1), []).append((i, x))
+
+                if self.ac4_counter[(i, j, x)] == 0 and assignment[i] & bit:
+                    # x has no support at all in the domain of j
+                    self.trail.append(('domain', i, assignment[i]))
+                    assignment[i] &= ~bit
+                    removals.append((i, x))
+
+        return removals
+
+    def inference(self, assignment, removals):
+        """The AC-4 algorithm, replacing the arc-revising AC-3 from the
+        pseudocode in the textbook. 'assignment' is the current partial
+        assignment, that contains the domain bitmasks of legal values
+        for each undecided variable. 'removals' is a list of
+        (variable, bit index) pairs for the values that have just been
+        deleted, whose consequences should be propagated.
+
+        Whenever a value y is removed from the domain of j, every value
+        x that counted y among its supports gets its support counter
+        decremented; when a counter reaches zero the value has no
+        support left and is pruned in turn, cascading until a fixpoint.
+        Unlike AC-3, no arc is ever re-scanned - each (x, y) support
+        pair is examined at most once per call. All counter decrements
+        and domain prunings are recorded on the trail, so backtrack can
+        undo them.
+
+        The worklist is a FIFO deque, so removals are propagated in the
+        order they happened, which gives a reproducible propagation
+        order. No seen-check is needed: a value can only be removed once
+        before the trail restores it, so no removal is ever enqueued
+        twice.
         """
-        revised = False
-
-        for x in assignment[i]:
-            # If no values in domain of j (= assignment[j]) allows x to satisfy constraints
-            # between i and j
-            if not any(((x, y) in self.constraints[i][j] for y in assignment[j])):
-                assignment[i].remove(x)
-                revised = True
-                
-        return revised
+        # Hoist every attribute and method used by the inner loop into
+        # locals, so the loop itself only performs local loads and
+        # integer operations - the same flat shape a JIT compiler would
+        # need, and noticeably faster under plain CPython as well
+        queue = deque(removals)
+        popleft = queue.popleft
+        push = queue.append
+        support_list_get = self.ac4_support_list.get
+        counter = self.ac4_counter
+        trail_append = self.trail.append
+        unassigned = self.unassigned
+        neq_watch = self._neq_watch
+        no_support = ()
+
+        while queue:
+            (j, y) = popleft()
+
+            # 'Not equal' arcs watching j fire as soon as j is down to a
+            # single value z: z is simply cleared from the watching
+            # domains, no counters involved
+            domain_j = assignment[j]
+            if domain_j == 0:
+                # An earlier queued removal emptied j before this entry
+                # was popped. Without this guard the single-value test
+                # below would pass and watch[-1] would fire the watches
+                # with whatever value happens to be last in the table
+                return False
+            if domain_j & (domain_j - 1) == 0:
+                z = domain_j.bit_length() - 1
+                for (i, watch) in neq_watch[j]:
+                    mask = watch[z]
+                    if mask and assignment[i] & mask:
+                        trail_append(('domain', i, assignment[i]))
+                        new_domain = assignment[i] & ~mask
+                        assignment[i] = new_domain
+                        if new_domain == 0:
+                            # The domain of i is empty - no solution
+                            return False
+                        if new_domain & (new_domain - 1) == 0 and i in unassigned:
+                            unassigned.remove(i)
+                            trail_append(('unassigned', i, None))
+                        push((i, mask.bit_length() - 1))
+
+            for (i, x) in support_list_get((j, y), no_support):
+                bit = 1 << x
+                if not assignment[i] & bit:
+                    # x is already gone from the domain of i
+                    continue
+
+                key = (i, j, x)
+                count = counter[key] - 1
+                trail_append(('counter', key, count + 1))
+                counter[key] = count
+
+                if count == 0:
+                    # x lost its last support in the domain of j - prune
+                    # it and propagate the removal
+                    trail_append(('domain', i, assignment[i]))
+                    new_domain = assignment[i] & ~bit
+                    assignment[i] = new_domain
+                    if new_domain == 0:
+                        # The domain of i is empty - no solution
+                        return False
+                    if new_domain & (new_domain - 1) == 0 and i in unassigned:
+                        # The pruning decided i - take it out of the
+                        # unassigned set until the trail restores it
+                        unassigned.remove(i)
+                        trail_append(('unassigned', i, None))
+                    push((i, x))
+        return True
 
 
 def create_map_coloring_csp():